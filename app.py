@@ -1,29 +1,80 @@
 # app.py
 import streamlit as st
-import uuid
+import pandas as pd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
 from PIL import Image
-from vision import count_products_in_image
+
+# Give up on a background image count once it has been running for this many
+# seconds, e.g. if the worker hangs on the first torch.hub download.
+COUNT_TIMEOUT_S = 300
 
 # ------------------------------------------------------------------------------
 # Session State Initialization
 # ------------------------------------------------------------------------------
 def init_session_state():
     """Initialize session state variables if not already present."""
+    if "next_id" not in st.session_state:
+        st.session_state.next_id = 0
     if "products" not in st.session_state:
         st.session_state.products = []
+    if "products_by_id" not in st.session_state:
+        st.session_state.products_by_id = {p["id"]: p for p in st.session_state.products}
     if "bins" not in st.session_state:
         st.session_state.bins = []
+    if "bins_by_id" not in st.session_state:
+        st.session_state.bins_by_id = {b["id"]: b for b in st.session_state.bins}
     if "counts" not in st.session_state:
         st.session_state.counts = []
+    if "pending_by_bin" not in st.session_state:
+        st.session_state.pending_by_bin = {}
+        for c in st.session_state.counts:
+            if c["status"] == "pending":
+                st.session_state.pending_by_bin.setdefault(c["binId"], []).append(c)
+    if "pending_uploads" not in st.session_state:
+        st.session_state.pending_uploads = {}
+    if "count_results" not in st.session_state:
+        st.session_state.count_results = {}
+    if "count_jobs" not in st.session_state:
+        st.session_state.count_jobs = {}
+
+@st.cache_resource
+def get_count_worker() -> dict:
+    """
+    Shared worker thread that runs image counts off the Streamlit script thread,
+    plus the jobs submitted to it by every session.
+    """
+    return {"executor": ThreadPoolExecutor(max_workers=1), "jobs": [], "lock": threading.Lock()}
+
+def _timed_out(job_state: dict) -> bool:
+    """True once a job has been running on the worker for longer than COUNT_TIMEOUT_S."""
+    started_at = job_state["startedAt"]
+    return started_at is not None and time.monotonic() - started_at > COUNT_TIMEOUT_S
+
+def count_worker_stuck() -> bool:
+    """
+    True while a count that ran past COUNT_TIMEOUT_S still occupies the worker.
+    Every later count, from any session, would queue behind it.
+    """
+    worker = get_count_worker()
+    with worker["lock"]:
+        return any(not j["future"].done() and _timed_out(j["state"]) for j in worker["jobs"])
 
 # ------------------------------------------------------------------------------
 # Data Manipulation Functions
 # ------------------------------------------------------------------------------
+def _new_id() -> int:
+    """Return the next id from the session's monotonic counter."""
+    st.session_state.next_id += 1
+    return st.session_state.next_id
+
 def add_product(sku: str, name: str, category: str, strain: str) -> None:
     """Add a new product to the inventory."""
     product = {
-        "id": uuid.uuid4().hex,
+        "id": _new_id(),
         "sku": sku,
         "name": name,
         "category": category,
@@ -34,56 +85,58 @@ def add_product(sku: str, name: str, category: str, strain: str) -> None:
         "currentBin": None,
     }
     st.session_state.products.append(product)
+    st.session_state.products_by_id[product["id"]] = product
 
 def add_bin(code: str, location: str, capacity: int) -> None:
     """Add a new storage bin."""
     bin_obj = {
-        "id": uuid.uuid4().hex,
+        "id": _new_id(),
         "code": code,
         "location": location,
         "capacity": capacity,
         "currentCount": 0,
-        "products": [],
+        "products": set(),
     }
     st.session_state.bins.append(bin_obj)
+    st.session_state.bins_by_id[bin_obj["id"]] = bin_obj
 
-def assign_product_to_bin(product_id: str, new_bin_id: str or None) -> None:
+def assign_product_to_bin(product_id: int, new_bin_id: int or None) -> None:
     """
     Assign (or unassign) a product to a bin.
     If the product is already assigned to another bin, remove it from the old bin.
     """
-    product = next((p for p in st.session_state.products if p["id"] == product_id), None)
+    product = st.session_state.products_by_id.get(product_id)
     if product is None:
         st.error("Product not found.")
         return
 
     old_bin_id = product.get("currentBin")
     if old_bin_id and old_bin_id != new_bin_id:
-        old_bin = next((b for b in st.session_state.bins if b["id"] == old_bin_id), None)
+        old_bin = st.session_state.bins_by_id.get(old_bin_id)
         if old_bin and product_id in old_bin["products"]:
-            old_bin["products"].remove(product_id)
+            old_bin["products"].discard(product_id)
             old_bin["currentCount"] = max(0, old_bin["currentCount"] - 1)
 
     if new_bin_id:
-        new_bin = next((b for b in st.session_state.bins if b["id"] == new_bin_id), None)
+        new_bin = st.session_state.bins_by_id.get(new_bin_id)
         if new_bin:
-            new_bin["products"].append(product_id)
+            new_bin["products"].add(product_id)
             new_bin["currentCount"] += 1
         product["currentBin"] = new_bin_id
     else:
         product["currentBin"] = None
 
-def create_inventory_count(bin_id: str) -> None:
+def create_inventory_count(bin_id: int) -> None:
     """
     Create a new inventory count record for a given bin.
     """
-    bin_obj = next((b for b in st.session_state.bins if b["id"] == bin_id), None)
+    bin_obj = st.session_state.bins_by_id.get(bin_id)
     if not bin_obj:
         st.error("Bin not found.")
         return
 
     count = {
-        "id": uuid.uuid4().hex,
+        "id": _new_id(),
         "binId": bin_id,
         "expectedCount": bin_obj["currentCount"],
         "actualCount": 0,
@@ -91,17 +144,18 @@ def create_inventory_count(bin_id: str) -> None:
         "timestamp": datetime.now().isoformat(),
     }
     st.session_state.counts.append(count)
+    st.session_state.pending_by_bin.setdefault(bin_id, []).append(count)
     st.success(f"Inventory count started for bin {bin_obj['code']}.")
 
-def update_inventory_count(bin_id: str, actual_count: int) -> None:
+def update_inventory_count(bin_id: int, actual_count: int) -> None:
     """
     Update the latest pending inventory count for a bin with the actual count from YOLO.
     """
-    pending_counts = [c for c in st.session_state.counts if c["binId"] == bin_id and c["status"] == "pending"]
+    pending_counts = st.session_state.pending_by_bin.get(bin_id)
     if not pending_counts:
         st.error("No pending inventory count for this bin. Please start a count first.")
         return
-    count_record = pending_counts[-1]
+    count_record = pending_counts.pop()
     count_record["actualCount"] = actual_count
     if actual_count == count_record["expectedCount"]:
         count_record["status"] = "completed"
@@ -109,9 +163,93 @@ def update_inventory_count(bin_id: str, actual_count: int) -> None:
         count_record["status"] = "discrepancy"
     st.success(f"Inventory count updated: Actual={actual_count}, Expected={count_record['expectedCount']}.")
 
+def _count_on_worker(job_state: dict, list_of_image_bytes: list) -> list:
+    """
+    Run a batched count on the executor thread. vision (and torch with it) is
+    imported here so neither the other tabs nor the script thread wait on it.
+    The timeout clock starts here, not while the job waits behind other counts.
+    """
+    job_state["startedAt"] = time.monotonic()
+    from vision import count_products_batch
+
+    return count_products_batch(list_of_image_bytes, render=True)
+
+def run_pending_counts() -> None:
+    """
+    Submit all queued bin uploads as a single batched inference on the background executor.
+    """
+    pending = st.session_state.pending_uploads
+    if not pending:
+        st.info("No bin images waiting to be counted.")
+        return
+    if count_worker_stuck():
+        st.warning("The image counter is still busy with an earlier count that timed out. Please try again once it finishes.")
+        return
+    bin_ids = list(pending)
+    worker = get_count_worker()
+    job_state = {"startedAt": None}
+    future = worker["executor"].submit(
+        _count_on_worker, job_state, [pending[bin_id]["bytes"] for bin_id in bin_ids]
+    )
+    with worker["lock"]:
+        worker["jobs"] = [j for j in worker["jobs"] if not j["future"].done()]
+        worker["jobs"].append({"future": future, "state": job_state})
+    for index, bin_id in enumerate(bin_ids):
+        st.session_state.count_jobs[bin_id] = {
+            "fileId": pending[bin_id]["fileId"],
+            "future": future,
+            "index": index,
+            "state": job_state,
+        }
+    pending.clear()
+
+def collect_count_result(bin_id: int) -> None:
+    """
+    Move a bin's finished background count into count_results, or drop it once it
+    has been running longer than COUNT_TIMEOUT_S.
+    """
+    job = st.session_state.count_jobs.get(bin_id)
+    if job is None:
+        return
+    if not job["future"].done():
+        if _timed_out(job["state"]):
+            del st.session_state.count_jobs[bin_id]
+            st.error("Image count timed out.")
+        return
+    del st.session_state.count_jobs[bin_id]
+    try:
+        actual_count, processed_image = job["future"].result()[job["index"]]
+    except Exception as e:
+        st.error(f"Image count failed: {e}")
+        return
+    if actual_count is None:
+        # Keep the error as this file's result so the bad upload isn't queued again
+        st.session_state.count_results[bin_id] = {
+            "fileId": job["fileId"],
+            "error": "Could not decode this image. Please upload a JPG or PNG file.",
+        }
+        return
+    st.session_state.count_results[bin_id] = {
+        "fileId": job["fileId"],
+        "actualCount": actual_count,
+        "image": Image.open(BytesIO(processed_image)),
+    }
+
 # ------------------------------------------------------------------------------
 # UI Rendering Functions
 # ------------------------------------------------------------------------------
+@st.fragment(run_every="1s")
+def poll_count_jobs():
+    """
+    Check background image counts once a second and rerun the app when one finishes
+    or times out. Only this fragment reruns while waiting, not the tabs.
+    """
+    if any(
+        job["future"].done() or _timed_out(job["state"])
+        for job in st.session_state.count_jobs.values()
+    ):
+        st.rerun()
+
 def render_products_tab():
     st.header("Products")
     with st.form("add_product_form", clear_on_submit=True):
@@ -128,29 +266,31 @@ def render_products_tab():
                 st.success("Product added!")
     st.subheader("Product List")
     if st.session_state.products:
+        bin_options = [("Unassigned", None)] + [
+            (f"{b['code']} ({b['location']})", b["id"]) for b in st.session_state.bins
+        ]
+        bin_index_by_id = {bin_id: i for i, (_, bin_id) in enumerate(bin_options)}
+        bin_label_by_id = {bin_id: label for label, bin_id in bin_options}
+        products_df = pd.DataFrame(st.session_state.products)
+        products_df["assignedBin"] = [
+            bin_label_by_id.get(p["currentBin"], "Unknown") for p in st.session_state.products
+        ]
+        st.dataframe(
+            products_df[["sku", "name", "category", "strain", "assignedBin"]].rename(columns={
+                "sku": "SKU",
+                "name": "Name",
+                "category": "Category",
+                "strain": "Strain",
+                "assignedBin": "Assigned Bin",
+            }),
+            hide_index=True,
+            use_container_width=True,
+        )
         for product in st.session_state.products:
             with st.expander(f"{product['name']} (SKU: {product['sku']})"):
-                st.write(f"**Category:** {product['category']}")
-                st.write(f"**Strain:** {product['strain']}")
                 current_bin = product.get("currentBin")
-                if current_bin:
-                    bin_obj = next((b for b in st.session_state.bins if b["id"] == current_bin), None)
-                    if bin_obj:
-                        st.write(f"**Assigned Bin:** {bin_obj['code']} ({bin_obj['location']})")
-                    else:
-                        st.write("**Assigned Bin:** Unknown")
-                else:
-                    st.write("**Assigned Bin:** Unassigned")
                 with st.form(key=f"assign_form_{product['id']}", clear_on_submit=True):
-                    bin_options = [("Unassigned", None)]
-                    for b in st.session_state.bins:
-                        bin_options.append((f"{b['code']} ({b['location']})", b["id"]))
-                    initial_index = 0
-                    if current_bin:
-                        for i, (_, bin_id) in enumerate(bin_options):
-                            if bin_id == current_bin:
-                                initial_index = i
-                                break
+                    initial_index = bin_index_by_id.get(current_bin, 0)
                     selected = st.selectbox(
                         "Assign to Bin",
                         options=bin_options,
@@ -178,6 +318,11 @@ def render_bins_tab():
                 st.success("Storage bin added!")
     st.subheader("Storage Bins List")
     if st.session_state.bins:
+        if st.button("Run Counts"):
+            run_pending_counts()
+        for bin_id in list(st.session_state.count_jobs):
+            collect_count_result(bin_id)
+        worker_stuck = count_worker_stuck()
         for bin_obj in st.session_state.bins:
             with st.expander(f"{bin_obj['code']} ({bin_obj['location']})"):
                 st.write(f"**Capacity:** {bin_obj['currentCount']} / {bin_obj['capacity']}")
@@ -186,28 +331,60 @@ def render_bins_tab():
                     create_inventory_count(bin_obj["id"])
                 st.markdown("#### Image-Based Inventory Count")
                 uploaded_file = st.file_uploader("Upload bin image for count", type=["jpg", "jpeg", "png"], key=f"upload_{bin_obj['id']}")
-                if uploaded_file is not None:
-                    st.info("Processing image...")
-                    actual_count, processed_image = count_products_in_image(uploaded_file.read())
-                    st.image(processed_image, caption=f"Detected count: {actual_count}", use_column_width=True)
+                if uploaded_file is None:
+                    st.session_state.pending_uploads.pop(bin_obj["id"], None)
+                    st.session_state.count_results.pop(bin_obj["id"], None)
+                    st.session_state.count_jobs.pop(bin_obj["id"], None)
+                    continue
+                result = st.session_state.count_results.get(bin_obj["id"])
+                job = st.session_state.count_jobs.get(bin_obj["id"])
+                if result is not None and result["fileId"] == uploaded_file.file_id and "error" in result:
+                    st.error(result["error"])
+                elif result is not None and result["fileId"] == uploaded_file.file_id:
+                    actual_count = result["actualCount"]
+                    st.image(result["image"], caption=f"Detected count: {actual_count}", use_column_width=True)
                     if st.button("Update Count", key=f"update_count_{bin_obj['id']}"):
                         update_inventory_count(bin_obj["id"], actual_count)
+                elif job is not None and job["fileId"] == uploaded_file.file_id:
+                    if job["state"]["startedAt"] is None:
+                        st.info("Waiting for earlier image counts to finish...")
+                    else:
+                        st.info("Processing image...")
+                else:
+                    st.session_state.pending_uploads[bin_obj["id"]] = {
+                        "fileId": uploaded_file.file_id,
+                        "bytes": uploaded_file.getvalue(),
+                    }
+                    if worker_stuck:
+                        st.warning("Image queued, but the image counter is still busy with an earlier count that timed out. Run the count once it finishes.")
+                    else:
+                        st.info("Image queued. Click \"Run Counts\" to process all uploaded images.")
+        # Only register the polling fragment while counts are running
+        if st.session_state.count_jobs:
+            poll_count_jobs()
     else:
         st.info("No storage bins added yet.")
 
 def render_inventory_tab():
     st.header("Inventory Counts")
     if st.session_state.counts:
-        for count in st.session_state.counts:
-            bin_obj = next((b for b in st.session_state.bins if b["id"] == count["binId"]), None)
-            bin_display = bin_obj["code"] if bin_obj else "Unknown"
-            st.write(f"**Bin:** {bin_display}")
-            st.write(f"**Expected Count:** {count['expectedCount']}")
-            st.write(f"**Actual Count:** {count['actualCount']}")
-            st.write(f"**Status:** {count['status']}")
-            timestamp = datetime.fromisoformat(count["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
-            st.write(f"**Timestamp:** {timestamp}")
-            st.markdown("---")
+        bins_by_id = st.session_state.bins_by_id
+        counts_df = pd.DataFrame(st.session_state.counts)
+        counts_df["bin"] = counts_df["binId"].map(
+            lambda bin_id: bins_by_id[bin_id]["code"] if bin_id in bins_by_id else "Unknown"
+        )
+        counts_df["timestamp"] = pd.to_datetime(counts_df["timestamp"]).dt.strftime("%Y-%m-%d %H:%M:%S")
+        st.dataframe(
+            counts_df[["bin", "expectedCount", "actualCount", "status", "timestamp"]].rename(columns={
+                "bin": "Bin",
+                "expectedCount": "Expected Count",
+                "actualCount": "Actual Count",
+                "status": "Status",
+                "timestamp": "Timestamp",
+            }),
+            hide_index=True,
+            use_container_width=True,
+        )
     else:
         st.info("No inventory counts available.")
 
@@ -0,0 +1,38 @@
+# letterbox.py
+from numba import njit, prange
+
+@njit(parallel=True, fastmath=True, cache=True)
+def preprocess(src_u8, dst):
+    """
+    Letterbox an HWC uint8 RGB image into a preallocated (3, size, size) float32 buffer.
+
+    Bilinear resize, padding, channel transpose and the divide by 255 happen in a
+    single pass over the output pixels, parallelised across rows.
+    Returns the resize ratio and the (left, top) padding so detections can be
+    mapped back onto the original image.
+    """
+    h, w = src_u8.shape[0], src_u8.shape[1]
+    size = dst.shape[1]
+    ratio = min(size / h, size / w)
+    new_h, new_w = round(h * ratio), round(w * ratio)
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    for y in prange(size):
+        inside_y = top <= y < top + new_h
+        sy = min(max((y - top + 0.5) * h / new_h - 0.5, 0.0), h - 1.0)
+        y0 = int(sy)
+        y1 = min(y0 + 1, h - 1)
+        fy = sy - y0
+        for x in range(size):
+            if not (inside_y and left <= x < left + new_w):
+                for c in range(3):
+                    dst[c, y, x] = 114 / 255
+                continue
+            sx = min(max((x - left + 0.5) * w / new_w - 0.5, 0.0), w - 1.0)
+            x0 = int(sx)
+            x1 = min(x0 + 1, w - 1)
+            fx = sx - x0
+            for c in range(3):
+                top_row = src_u8[y0, x0, c] * (1 - fx) + src_u8[y0, x1, c] * fx
+                bottom_row = src_u8[y1, x0, c] * (1 - fx) + src_u8[y1, x1, c] * fx
+                dst[c, y, x] = (top_row * (1 - fy) + bottom_row * fy) / 255
+    return ratio, (left, top)
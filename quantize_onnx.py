@@ -0,0 +1,106 @@
+# quantize_onnx.py
+"""
+One-time INT8 quantization of the exported YOLOv5 ONNX model for CPU inference.
+
+Usage:
+    python quantize_onnx.py yolov5s.onnx path/to/bin_images [--output yolov5s.int8.onnx]
+                            [--check-dir path/to/held_out_images]
+
+The input model must be an FP32 export (without --half). Around 100 bin
+images make a good calibration set. After quantizing, the FP32 and INT8
+models are run on the --check-dir images (the calibration images by default)
+and their counts are printed side by side.
+"""
+import argparse
+import os
+import re
+import onnx
+import onnxruntime as ort
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_static,
+)
+from vision import COUNT_CONF, decode_image, preprocess_batch, run_onnx, split_detections
+
+# Nodes of YOLOv5's Detect head (module model.24 in the PyTorch graph). It
+# concatenates pixel coordinates (0-640) with probabilities (0-1) into one
+# tensor, which a single per-tensor INT8 scale cannot represent, so it stays FP32.
+DETECT_HEAD = re.compile(r"\bmodel\.24\b")
+
+def image_paths(image_dir: str) -> list:
+    """Sorted paths of the jpg/png images in a directory."""
+    return sorted(
+        os.path.join(image_dir, f) for f in os.listdir(image_dir)
+        if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+
+def load_image(path: str):
+    """Read and decode an image file into an RGB numpy array."""
+    with open(path, "rb") as f:
+        return decode_image(f.read())
+
+def detect_head_nodes(model_path: str) -> list:
+    """Names of the Detect head nodes to leave unquantized."""
+    return [n.name for n in onnx.load(model_path).graph.node if DETECT_HEAD.search(n.name)]
+
+class BinImageReader(CalibrationDataReader):
+    """Feed letterboxed bin images to the static quantizer one at a time."""
+
+    def __init__(self, model_path: str, image_dir: str):
+        session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = session.get_inputs()[0].name
+        self.paths = iter(image_paths(image_dir))
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        blob, _ = preprocess_batch([load_image(path)])
+        return {self.input_name: blob}
+
+def compare_counts(fp32_path: str, int8_path: str, image_dir: str) -> None:
+    """Print the FP32 and INT8 models' counts for each image and their mean difference."""
+    sessions = [
+        ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        for path in (fp32_path, int8_path)
+    ]
+    diffs = []
+    for path in image_paths(image_dir):
+        img_np = load_image(path)
+        fp32_count, int8_count = [
+            int((split_detections(run_onnx(session, [img_np])[0])[1] >= COUNT_CONF).sum())
+            for session in sessions
+        ]
+        diffs.append(abs(fp32_count - int8_count))
+        print(f"{os.path.basename(path)}: fp32={fp32_count} int8={int8_count}")
+    if diffs:
+        print(f"Mean absolute count difference over {len(diffs)} images: {sum(diffs) / len(diffs):.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model_path")
+    parser.add_argument("image_dir")
+    parser.add_argument("--output", default="yolov5s.int8.onnx")
+    parser.add_argument("--check-dir", help="images to compare FP32 and INT8 counts on")
+    args = parser.parse_args()
+
+    nodes_to_exclude = detect_head_nodes(args.model_path)
+    if not nodes_to_exclude:
+        print("Warning: no model.24 Detect head nodes found; only Conv layers will be quantized.")
+    quantize_static(
+        args.model_path,
+        args.output,
+        BinImageReader(args.model_path, args.image_dir),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        op_types_to_quantize=['Conv'],
+        nodes_to_exclude=nodes_to_exclude,
+    )
+    print(f"Wrote {args.output}")
+    compare_counts(args.model_path, args.output, args.check_dir or args.image_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,422 @@
 # vision.py
+import hashlib
+import os
+import threading
+import warnings
+import cv2
 import torch
+import torchvision
 import numpy as np
+import streamlit as st
+from collections import OrderedDict
 from io import BytesIO
 from PIL import Image
 
-# Load YOLOv5 model from torch.hub globally.
-# Note: On first run, this will download the model weights.
-model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
-model.eval()  # set model to evaluation mode
+# Run inference on the GPU in half precision when one is available,
+# otherwise fall back to FP32 on the CPU.
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+HALF = DEVICE == 'cuda'
 
-def count_products_in_image(image_bytes):
+# Optional ONNX Runtime backend. When the exported model exists it is used
+# instead of the PyTorch hub model (see README for the export step).
+ONNX_WEIGHTS = os.environ.get('CANNACOUNT_ONNX', 'yolov5s.onnx')
+# INT8-quantized model (see quantize_onnx.py), preferred when running on the CPU.
+ONNX_INT8_WEIGHTS = os.environ.get('CANNACOUNT_ONNX_INT8', 'yolov5s.int8.onnx')
+IMG_SIZE = 640
+
+# Set CANNACOUNT_TRACE=1 to run a torch.jit.trace'd copy of the network with
+# our own pre/postprocessing instead of the hub model's AutoShape wrapper.
+TRACE = os.environ.get('CANNACOUNT_TRACE') == '1'
+# Largest batch copied to the GPU at once through the pinned staging buffer.
+MAX_BATCH = 8
+# Number of per-image count results kept by get_count_cache().
+COUNT_CACHE_SIZE = 64
+
+# Detection thresholds. Boxes above CONF_THRES survive NMS; only those scoring
+# at least COUNT_CONF are counted and drawn.
+CONF_THRES = 0.4
+IOU_THRES = 0.5
+COUNT_CONF = 0.5
+# COCO class ids to count, e.g. CANNACOUNT_CLASSES="39,41" for bottles and cups.
+# None counts every class until the model is fine-tuned on product images.
+TARGET_CLASSES = (
+    [int(c) for c in os.environ['CANNACOUNT_CLASSES'].split(',')]
+    if os.environ.get('CANNACOUNT_CLASSES') else None
+)
+
+@st.cache_resource
+def get_model():
+    """
+    Load the YOLOv5 model from torch.hub once per process.
+
+    The model is shared across Streamlit reruns and sessions instead of being
+    reloaded every time the script re-imports this module.
+    Note: On first run, this will download the model weights.
+    """
+    m = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+    m.eval()  # set model to evaluation mode
+    m.conf = CONF_THRES
+    m.iou = IOU_THRES
+    m.classes = TARGET_CLASSES
+    m.to(DEVICE)
+    if HALF:
+        m.half()
+    # Warm up CUDA kernels and the allocator so the first real upload doesn't stall
+    with torch.inference_mode():
+        m(np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8))
+    return m
+
+@st.cache_resource
+def get_traced_model():
+    """
+    Trace the YOLOv5 network behind the hub model with torch.jit.trace once per process.
+
+    The traced module takes a (B, 3, 640, 640) tensor and returns the raw
+    predictions, so it is used with preprocess_batch() and postprocess() rather than
+    AutoShape. Returns None unless CANNACOUNT_TRACE=1.
+    """
+    if not TRACE:
+        return None
+    net = get_model().model.model  # AutoShape -> DetectMultiBackend -> DetectionModel
+    dummy = torch.zeros(
+        1, 3, IMG_SIZE, IMG_SIZE, device=DEVICE,
+        dtype=torch.float16 if HALF else torch.float32,
+    )
+    with torch.no_grad():
+        traced = torch.jit.trace(net, dummy, strict=False)
+        traced(dummy)  # warm up the traced graph
+    return traced
+
+@st.cache_resource
+def get_onnx_session():
+    """
+    Load the exported ONNX model into an ONNX Runtime session once per process.
+
+    Without a GPU, the INT8-quantized model is used when it exists. FP16 models
+    are only loaded when ONNX Runtime's CUDA provider is available, since the CPU
+    provider has no FP16 kernels for them.
+    Returns None when no usable model file or onnxruntime is available, or the
+    session cannot be created, in which case inference falls back to the PyTorch
+    model from get_model().
+    """
+    use_int8 = DEVICE == 'cpu' and os.path.exists(ONNX_INT8_WEIGHTS)
+    if not use_int8 and not os.path.exists(ONNX_WEIGHTS):
+        return None
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    if use_int8:
+        weights, providers = ONNX_INT8_WEIGHTS, ['CPUExecutionProvider']
+    elif 'CUDAExecutionProvider' in ort.get_available_providers():
+        weights, providers = ONNX_WEIGHTS, ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    else:
+        weights, providers = ONNX_WEIGHTS, ['CPUExecutionProvider']
+    try:
+        session = ort.InferenceSession(weights, providers=providers)
+    except Exception as e:
+        warnings.warn(f"Could not load {weights} with ONNX Runtime, using PyTorch: {e}")
+        return None
+    fp16 = session.get_inputs()[0].type == 'tensor(float16)'
+    if fp16 and 'CUDAExecutionProvider' not in session.get_providers():
+        warnings.warn(f"{weights} is an FP16 model but CUDA is unavailable to ONNX Runtime, using PyTorch.")
+        return None
+    return session
+
+def postprocess(pred, ratio, pad, shape):
+    """
+    Turn raw YOLOv5 output rows [cx, cy, w, h, obj, cls...] into detections.
+
+    Applies the confidence threshold, the TARGET_CLASSES filter and class-wise
+    NMS, then rescales boxes to the original image. Returns an (N, 6) tensor of
+    [x1, y1, x2, y2, conf, class], the same layout as results.xyxy[0] from the
+    PyTorch model.
+    """
+    pred = torch.as_tensor(pred).float()
+    pred = pred[pred[:, 4] > CONF_THRES]
+    conf, cls = (pred[:, 5:] * pred[:, 4:5]).max(1)
+    keep = conf > CONF_THRES
+    if TARGET_CLASSES is not None:
+        keep &= torch.isin(cls, torch.tensor(TARGET_CLASSES, device=cls.device))
+    pred, conf, cls = pred[keep], conf[keep], cls[keep]
+
+    boxes = torch.empty((pred.shape[0], 4), device=pred.device)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+    keep = torchvision.ops.batched_nms(boxes, conf, cls, IOU_THRES)
+    boxes, conf, cls = boxes[keep], conf[keep], cls[keep]
+
+    boxes[:, [0, 2]] -= pad[0]
+    boxes[:, [1, 3]] -= pad[1]
+    boxes /= ratio
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(0, shape[1])
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(0, shape[0])
+    return torch.cat([boxes, conf[:, None], cls[:, None].float()], 1)
+
+def draw_detections(img_np, detections):
+    """Draw detection boxes onto a copy of an RGB image."""
+    annotated = img_np.copy()
+    for x1, y1, x2, y2, _, _ in detections.tolist():
+        cv2.rectangle(annotated, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
+    return annotated
+
+@st.cache_resource
+def get_staging():
+    """
+    Allocate the pinned host buffer and CUDA stream used to feed the traced model.
+
+    Returns None when running on the CPU.
+    """
+    if DEVICE != 'cuda':
+        return None
+    return {
+        'buffer': torch.empty(
+            (MAX_BATCH, 3, IMG_SIZE, IMG_SIZE), dtype=torch.float32, pin_memory=True
+        ),
+        'stream': torch.cuda.Stream(),
+        'lock': threading.Lock(),
+    }
+
+def preprocess_batch(images, out=None):
+    """
+    Letterbox a list of RGB images into one (B, 3, 640, 640) float32 batch.
+
+    Writes into out when given, otherwise allocates a new array.
+    Returns the batch and the (ratio, pad) pair for each image.
+    """
+    # Imported here so the default AutoShape path never loads numba/llvmlite
+    from letterbox import preprocess
+
+    if out is None:
+        blob = np.empty((len(images), 3, IMG_SIZE, IMG_SIZE), dtype=np.float32)
+    else:
+        blob = out
+    letterbox_params = [preprocess(img_np, blob[i]) for i, img_np in enumerate(images)]
+    return blob, letterbox_params
+
+def run_traced(traced, images):
+    """Run the traced YOLOv5 network on a list of RGB images and return their detections."""
+    staging = get_staging()
+    if staging is None:
+        blob, letterbox_params = preprocess_batch(images)
+        with torch.inference_mode():
+            pred = traced(torch.from_numpy(blob))[0]
+    else:
+        pred, letterbox_params = _run_traced_cuda(traced, images, staging)
+    return [
+        postprocess(p, ratio, pad, img_np.shape[:2])
+        for p, (ratio, pad), img_np in zip(pred, letterbox_params, images)
+    ]
+
+def _run_traced_cuda(traced, images, staging):
+    """
+    Run the traced network on the GPU, feeding it through the pinned staging buffer.
+
+    Images are preprocessed straight into pinned memory in chunks of MAX_BATCH and
+    copied with non_blocking=True on a side stream, so the CPU preprocesses the
+    next chunk while the GPU runs the current one.
+    Returns the predictions for all images and their letterbox parameters.
+    """
+    buffer, stream = staging['buffer'], staging['stream']
+    preds, letterbox_params = [], []
+    copied = None
+    with staging['lock'], torch.cuda.stream(stream), torch.inference_mode():
+        for start in range(0, len(images), MAX_BATCH):
+            chunk = images[start:start + MAX_BATCH]
+            if copied is not None:
+                copied.synchronize()  # previous chunk has left the staging buffer
+            _, params = preprocess_batch(chunk, out=buffer[:len(chunk)].numpy())
+            letterbox_params += params
+            x = buffer[:len(chunk)].to(DEVICE, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(stream)
+            if HALF:
+                x = x.half()
+            preds.append(traced(x)[0])
+        copied.synchronize()  # don't release the buffer while a copy is in flight
+    torch.cuda.current_stream().wait_stream(stream)
+    return torch.cat(preds), letterbox_params
+
+def run_onnx(session, images):
+    """
+    Run the ONNX Runtime session on a list of RGB images.
+
+    Images are stacked into a single (B, 3, 640, 640) batch when the model was
+    exported with a dynamic batch axis; otherwise they are run one at a time.
+    Returns one detections tensor per image.
+    """
+    model_input = session.get_inputs()[0]
+    blob, letterbox_params = preprocess_batch(images)
+    # Models exported with --half expect float16 input.
+    if model_input.type == 'tensor(float16)':
+        blob = blob.astype(np.float16)
+    if isinstance(model_input.shape[0], int):
+        pred = np.concatenate(
+            [session.run(None, {model_input.name: blob[i:i + 1]})[0] for i in range(len(images))]
+        )
+    else:
+        pred = session.run(None, {model_input.name: blob})[0]
+    return [
+        postprocess(p, ratio, pad, img_np.shape[:2])
+        for p, (ratio, pad), img_np in zip(pred, letterbox_params, images)
+    ]
+
+def to_png_bytes(img_np):
+    """Encode an RGB image array as PNG bytes."""
+    buffer = BytesIO()
+    Image.fromarray(img_np).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def decode_image(image_bytes):
+    """Decode uploaded image bytes into an RGB numpy array."""
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image.")
+    # Convert BGR to RGB in place rather than allocating a second image
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+def split_detections(det):
+    """
+    Split an (N, 6) detections tensor into separate boxes, scores and classes.
+
+    Returns (boxes (N, 4) as [x1, y1, x2, y2], scores (N,), classes (N,)) as views
+    on the same tensor, so no data is copied.
+    """
+    return det[:, :4], det[:, 4], det[:, 5]
+
+def _detect(images, render=True):
+    """
+    Run one batched YOLOv5 forward pass over RGB images.
+
+    Only detections scoring at least COUNT_CONF are kept, so the boxes drawn are
+    exactly the ones counted. Returns the (N, 6) detections tensor for each image
+    and, when render is True, the annotated images (None otherwise, skipping the
+    per-image drawing and copy).
+    """
+    annotated_images = None
+    session = get_onnx_session()
+    traced = get_traced_model() if session is None else None
+    if session is not None or traced is not None:
+        # Perform inference with the exported ONNX model or the traced network
+        if session is not None:
+            detections = run_onnx(session, images)
+        else:
+            detections = run_traced(traced, images)
+        detections = [det[det[:, 4] >= COUNT_CONF] for det in detections]
+        if render:
+            annotated_images = [draw_detections(img_np, det) for img_np, det in zip(images, detections)]
+    else:
+        # Perform inference. The YOLOv5 AutoShape wrapper letterboxes each array, stacks
+        # them into one batch and moves it to the model's device/dtype itself, so passing
+        # the numpy images keeps NMS and box rescaling intact on both the CUDA/FP16 and
+        # CPU/FP32 paths.
+        model = get_model()
+        with torch.inference_mode():
+            results = model(images)
+
+        # Drop detections below COUNT_CONF in place so render() only draws counted boxes
+        for i, det in enumerate(results.pred):
+            results.pred[i] = det[det[:, 4] >= COUNT_CONF]
+
+        # Render annotated images (results.render() returns list of numpy arrays)
+        if render:
+            annotated_images = results.render()
+
+        # Raw detections in original image coordinates (each: [x1, y1, x2, y2, conf, class])
+        detections = results.pred
+    return detections, annotated_images
+
+def _count_products(list_of_image_bytes, render=True):
+    """
+    Run one batched YOLOv5 forward pass and return (count, png_bytes) per image.
+
+    With render=False the annotated images are not drawn and None is returned
+    in their place. Images that cannot be decoded are left out of the forward
+    pass and get (None, None).
+    """
+    images, decoded = [], []
+    for i, image_bytes in enumerate(list_of_image_bytes):
+        try:
+            images.append(decode_image(image_bytes))
+        except ValueError:
+            continue
+        decoded.append(i)
+    results = [(None, None)] * len(list_of_image_bytes)
+    if not images:
+        return results
+    detections, annotated_images = _detect(images, render)
+
+    # _detect() already dropped detections below COUNT_CONF, so every row is counted.
+    # The row counts are host-side shapes, so no extra device sync is needed.
+    counts = [det.shape[0] for det in detections]
+    for j, (i, count) in enumerate(zip(decoded, counts)):
+        results[i] = (count, to_png_bytes(annotated_images[j]) if render else None)
+    return results
+
+@st.cache_resource
+def get_count_cache():
+    """
+    Process-wide LRU cache of per-image count results, keyed on (sha256 of the
+    image bytes, render). Shared across reruns and sessions like st.cache_data,
+    but per image, so a batch only runs inference for the images it hasn't seen.
+    """
+    return {'results': OrderedDict(), 'lock': threading.Lock()}
+
+def count_products_batch(list_of_image_bytes, render=True):
+    """
+    Count products in several images with a single batched YOLOv5 forward pass.
+
+    Results are cached per image, so an image that was already counted (alone or
+    in any other batch) is not sent through inference again.
+
+    Args:
+        list_of_image_bytes (list[bytes]): The uploaded images in bytes.
+        render (bool): Draw the detections; pass False when only the counts are needed.
+
+    Returns:
+        list[tuple[int | None, bytes | None]]: (count, processed_image_png) for each input
+        image, in the same order. processed_image_png is None when render is False, and
+        both are None for an image that could not be decoded.
+    """
+    cache = get_count_cache()
+    keys = [(hashlib.sha256(b).digest(), render) for b in list_of_image_bytes]
+    results = [None] * len(keys)
+    with cache['lock']:
+        for i, key in enumerate(keys):
+            if key in cache['results']:
+                cache['results'].move_to_end(key)
+                results[i] = cache['results'][key]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    for i, result in zip(misses, _count_products([list_of_image_bytes[i] for i in misses], render)):
+        results[i] = result
+    with cache['lock']:
+        for i in misses:
+            cache['results'][keys[i]] = results[i]
+        while len(cache['results']) > COUNT_CACHE_SIZE:
+            cache['results'].popitem(last=False)
+    return results
+
+def count_products_in_image(image_bytes, render=True):
     """
     Count products in an image using YOLOv5.
     
+    Results are cached on the image bytes, so re-uploading or re-rendering the
+    same image does not repeat inference.
+
     Args:
         image_bytes (bytes): The uploaded image in bytes.
+        render (bool): Draw the detections; pass False when only the count is needed.
         
     Returns:
-        count (int): Estimated number of detected objects.
-        processed_image (PIL.Image): Image with detections drawn for visualization.
+        count (int | None): Estimated number of detected objects, or None when the
+            image could not be decoded.
+        processed_image (bytes | None): PNG-encoded image with detections drawn for
+            visualization, or None when render is False or the image could not be decoded.
     
     Note: For production, fine‑tune the model on your product images and filter detections
           to only count your target objects.
     """
-    # Load image from bytes
-    image = Image.open(BytesIO(image_bytes)).convert("RGB")
-    # Convert image to numpy array
-    img_np = np.array(image)
-    
-    # Perform inference
-    results = model(img_np)
-    
-    # Render annotated image (results.render() returns list of numpy arrays)
-    annotated_image_np = results.render()[0]
-    annotated_image = Image.fromarray(annotated_image_np)
-    
-    # Extract detections from results.xyxy[0] (each detection: [x1, y1, x2, y2, conf, class])
-    detections = results.xyxy[0]
-    # For demonstration, count all detections.
-    count = len(detections)
-    
-    return count, annotated_image
+    return count_products_batch([image_bytes], render)[0]